@@ -36,6 +36,9 @@ configuration = {"Case": 'Multi-Blobs',
                  "Spatial Resolution": 1,
                  "Temporal Resolution": 1,
                  "Gradient Clipping Norm": None, 
+                 "Spectral Weights": 'bf16',
+                 "FFT Padding": 'No',
+                 "Pretty Plots": False,
                 #  "UQ": 'Dropout',
                 #  "Dropout Rate": 0.9
                  }
@@ -67,13 +70,17 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-import matplotlib.pyplot as plt
-from matplotlib import cm 
+from matplotlib import colormaps
+from matplotlib.colors import Normalize
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from PIL import Image, ImageDraw
 
 import operator
 from functools import reduce
 from functools import partial
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import time 
 from timeit import default_timer
@@ -98,212 +105,33 @@ device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 ##################################
 
 
-# normalization, pointwise gaussian
-class UnitGaussianNormalizer(object):
-    def __init__(self, x, eps=0.00001):
-        super(UnitGaussianNormalizer, self).__init__()
-
-        # x could be in shape of ntrain*n or ntrain*T*n or ntrain*n*T
-        self.mean = torch.mean(x, 0)
-        self.std = torch.std(x, 0)
-        self.eps = eps
-
-    def encode(self, x):
-        x = (x - self.mean) / (self.std + self.eps)
-        return x
-
-    def decode(self, x, sample_idx=None):
-        if sample_idx is None:
-            std = self.std + self.eps # n
-            mean = self.mean
-        else:
-            if len(self.mean.shape) == len(sample_idx[0].shape):
-                std = self.std[sample_idx] + self.eps  # batch*n
-                mean = self.mean[sample_idx]
-            if len(self.mean.shape) > len(sample_idx[0].shape):
-                std = self.std[:,sample_idx]+ self.eps # T*batch*n
-                mean = self.mean[:,sample_idx]
-
-        # x is in shape of batch*n or T*batch*n
-        x = (x * std) + mean
-        return x
-
-    def cuda(self):
-        self.mean = self.mean.cuda()
-        self.std = self.std.cuda()
-
-    def cpu(self):
-        self.mean = self.mean.cpu()
-        self.std = self.std.cpu()
-
-# normalization, Gaussian
-class GaussianNormalizer(object):
-    def __init__(self, x, eps=0.00001):
-        super(GaussianNormalizer, self).__init__()
-
-        self.mean = torch.mean(x)
-        self.std = torch.std(x)
-        self.eps = eps
-
-    def encode(self, x):
-        x = (x - self.mean) / (self.std + self.eps)
-        return x
-
-    def decode(self, x, sample_idx=None):
-        x = (x * (self.std + self.eps)) + self.mean
-        return x
-
-    def cuda(self):
-        self.mean = self.mean.cuda()
-        self.std = self.std.cuda()
-
-    def cpu(self):
-        self.mean = self.mean.cpu()
-        self.std = self.std.cpu()
-
-
-# normalization, scaling by range
-class RangeNormalizer(object):
-    def __init__(self, x, low=-1.0, high=1.0):
-        super(RangeNormalizer, self).__init__()
-        mymin = torch.min(x, 0)[0].view(-1)
-        mymax = torch.max(x, 0)[0].view(-1)
+#normalization, rangewise but single value. 
+class MinMax_Normalizer(object):
+    def __init__(self, x, low=0.0, high=1.0):
+        super(MinMax_Normalizer, self).__init__()
+        #Per-variable min and max, shaped (1, vars, 1, 1, 1) to broadcast over (batch, vars, x, y, t)
+        mymin = torch.amin(x, dim=(0, 2, 3, 4), keepdim=True)
+        mymax = torch.amax(x, dim=(0, 2, 3, 4), keepdim=True)
 
         self.a = (high - low)/(mymax - mymin)
         self.b = -self.a*mymax + high
+        self.inv_a = 1/self.a
 
     def encode(self, x):
-        s = x.size()
-        x = x.reshape(s[0], -1)
-        x = self.a*x + self.b
-        x = x.view(s)
-        return x
+        return torch.addcmul(self.b, x, self.a)
 
     def decode(self, x):
-        s = x.size()
-        x = x.reshape(s[0], -1)
-        x = (x - self.b)/self.a
-        x = x.view(s)
-        return x
-
+        return (x - self.b).mul_(self.inv_a)
 
     def cuda(self):
         self.a = self.a.cuda()
         self.b = self.b.cuda()
+        self.inv_a = self.inv_a.cuda()
 
     def cpu(self):
         self.a = self.a.cpu()
         self.b = self.b.cpu()
-
-#normalization, rangewise but single value. 
-class MinMax_Normalizer(object):
-    def __init__(self, x, low=0.0, high=1.0):
-        super(MinMax_Normalizer, self).__init__()
-        min_u = torch.min(x[:,0,:,:,:])
-        max_u = torch.max(x[:,0,:,:,:])
-
-        self.a_u = (high - low)/(max_u - min_u)
-        self.b_u = -self.a_u*max_u + high
-
-        min_v = torch.min(x[:,1,:,:,:])
-        max_v = torch.max(x[:,1,:,:,:])
-
-        self.a_v = (high - low)/(max_v - min_v)
-        self.b_v = -self.a_v*max_v + high
-
-        min_p = torch.min(x[:,2,:,:,:])
-        max_p = torch.max(x[:,2,:,:,:])
-
-        self.a_p = (high - low)/(max_p - min_p)
-        self.b_p = -self.a_p*max_p + high
-        
-
-    def encode(self, x):
-        s = x.size()
-
-        u = x[:,0,:,:,:]
-        u = self.a_u*u + self.b_u
-
-        v = x[:,1,:,:,:]
-        v = self.a_v*v + self.b_v
-
-        p = x[:,2,:,:,:]
-        p = self.a_p*p + self.b_p
-        
-        x = torch.stack((u,v,p), dim=1)
-
-        return x
-
-    def decode(self, x):
-        s = x.size()
-
-        u = x[:,0,:,:,:]
-        u = (u - self.b_u)/self.a_u
-        
-        v = x[:,1,:,:,:]
-        v = (v - self.b_v)/self.a_v
-
-        p = x[:,2,:,:,:]
-        p = (p - self.b_p)/self.a_p
-
-
-        x = torch.stack((u,v,p), dim=1)
-
-        return x
-
-    def cuda(self):
-        self.a_u = self.a_u.cuda()
-        self.b_u = self.b_u.cuda()
-        
-        self.a_v = self.a_v.cuda()
-        self.b_v = self.b_v.cuda() 
-
-        self.a_p = self.a_p.cuda()
-        self.b_p = self.b_p.cuda()
-
-
-    def cpu(self):
-        self.a_u = self.a_u.cpu()
-        self.b_u = self.b_u.cpu()
-        
-        self.a_v = self.a_v.cpu()
-        self.b_v = self.b_v.cpu()
-
-        self.a_p = self.a_p.cpu()
-        self.b_p = self.b_p.cpu()
-
-
-# #normalization, rangewise but across the full domain 
-# class MinMax_Normalizer(object):
-#     def __init__(self, x, low=-1.0, high=1.0):
-#         super(MinMax_Normalizer, self).__init__()
-#         self.mymin = torch.min(x)
-#         self.mymax = torch.max(x)
-
-#         self.a = (high - low)/(self.mymax - self.mymin)
-#         self.b = -self.a*self.mymax + high
-
-#     def encode(self, x):
-#         s = x.size()
-#         x = x.reshape(s[0], -1)
-#         x = self.a*x + self.b
-#         x = x.view(s)
-#         return x
-
-#     def decode(self, x):
-#         s = x.size()
-#         x = x.reshape(s[0], -1)
-#         x = (x - self.b)/self.a
-#         x = x.view(s)
-#         return x
-
-#     def cuda(self):
-#         self.a = self.a.cuda()
-#         self.b = self.b.cuda()
-
-#     def cpu(self):
-#         self.a = self.a.cpu()
-#         self.b = self.b.cpu()
+        self.inv_a = self.inv_a.cpu()
 
 
 # %%
@@ -343,16 +171,22 @@ class LpLoss(object):
     def rel(self, x, y):
         num_examples = x.size()[0]
 
-        diff_norms = torch.norm(x.reshape(num_examples,-1) - y.reshape(num_examples,-1), self.p, 1)
-        y_norms = torch.norm(y.reshape(num_examples,-1), self.p, 1)
+        diff = (x - y).reshape(num_examples,-1)
+        y = y.reshape(num_examples,-1)
+
+        if self.p == 2:
+            #Ratio of the sums of squares, a single sqrt instead of one per norm
+            rel_norms = (diff.pow(2).sum(1) / y.pow(2).sum(1)).sqrt()
+        else:
+            rel_norms = torch.linalg.vector_norm(diff, self.p, 1) / torch.linalg.vector_norm(y, self.p, 1)
 
         if self.reduction:
             if self.size_average:
-                return torch.mean(diff_norms/y_norms)
+                return torch.mean(rel_norms)
             else:
-                return torch.sum(diff_norms/y_norms)
+                return torch.sum(rel_norms)
 
-        return diff_norms/y_norms
+        return rel_norms
 
     def __call__(self, x, y):
         return self.rel(x, y)
@@ -376,28 +210,73 @@ T_in = configuration['T_in']
 T = configuration['T_out']
 step = configuration['Step']
 num_vars = configuration['Variables']
+#Zero-padding to an FFT friendly size changes the function the network computes, unpadded models are not equivalent
+fft_padding = configuration['FFT Padding'] == 'Yes'
+#bf16 storage of the spectral weights only on the GPU, like autocast and the fused optimizer
+spectral_dtype = torch.bfloat16 if configuration['Spectral Weights'] == 'bf16' and torch.cuda.is_available() else torch.float
+configuration['Spectral Weights'] = 'bf16' if spectral_dtype == torch.bfloat16 else 'fp32'
+run.update_metadata({'Spectral Weights': configuration['Spectral Weights']})
 
 # %%
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
-# %%
-
-class MLP(nn.Module):
-    def __init__(self, in_channels, out_channels, mid_channels):
-        super(MLP, self).__init__()
-        self.mlp1 = nn.Conv2d(in_channels, mid_channels, 1)
-        self.mlp2 = nn.Conv2d(mid_channels, out_channels, 1)
-
-    def forward(self, x):
-        x = self.mlp1(x)
-        x = F.gelu(x)
-        x = self.mlp2(x)
-        return x
-
 # %%
 ################################################################
 # fourier layer
 ################################################################
+#Smallest size >= n with only 2, 3, 5 and 7 as prime factors, the lengths cuFFT transforms fastest (106 -> 108)
+def fft_size(n):
+    while True:
+        m = n
+        for p in (2, 3, 5, 7):
+            while m % p == 0:
+                m //= p
+        if m == 1:
+            return n
+        n += 1
+
+# Complex multiplication
+def compl_mul2d(input, weights):
+    # (batch*var, in_channel, x,y, 2), (var, x,y, 2, in_channel, out_channel) -> (batch*var, out_channel, x,y, 2)
+    #Real and imaginary parts in the last dimension. Done as a single real batched matmul over the (var, x, y) modes, 
+    #duplicating the small activation side rather than the weights: [[re(in), -im(in)], [im(in), re(in)]] @ [re(w); im(w)] = [re(out); im(out)]
+    #The weights are stored in matmul order, so [re(w); im(w)] is a reshape of the parameter. 
+    #The matmul runs in the storage precision of the weights: with bf16 weights the (small) spectrum is cast down and the weights 
+    #are read as stored, accumulating in fp32 with the output rounded to bf16. With fp32 weights it runs in TF32 on the GPU (matmul precision "high"). 
+    v, x, y, i, o = weights.shape[0], weights.shape[1], weights.shape[2], weights.shape[4], weights.shape[5]
+    input = input.unflatten(0, (-1, v))
+    b = input.shape[0]
+    in_re, in_im = input[..., 0].permute(1, 3, 4, 0, 2), input[..., 1].permute(1, 3, 4, 0, 2)
+    input = torch.stack((torch.cat((in_re, -in_im), dim=-1),
+                         torch.cat((in_im, in_re), dim=-1)), dim=-2).reshape(v*x*y, 2*b, 2*i).to(weights.dtype)
+
+    weights = weights.reshape(v*x*y, 2*i, o)
+
+    out = torch.bmm(input, weights).float()
+    return out.reshape(v, x, y, b, 2, o).permute(3, 0, 5, 1, 2, 4).flatten(0, 1)
+
+#FFT, spectral multiply and inverse FFT compiled as one graph, so the assembly of the output spectrum is fused with the multiply 
+@torch.compile(fullgraph=True, dynamic=False, disable=not torch.cuda.is_available())
+def spectral_conv2d(x, weights, modes1, modes2):
+    size_x, size_y = x.size(-2), x.size(-1)
+    #Compute only the retained Fourier coeffcients: rfft along y, truncate to modes2, then fft along x
+    x_ft = torch.fft.rfft(x, dim=-1)[..., :modes2]
+    x_ft = torch.view_as_real(torch.fft.fft(x_ft, dim=-2))
+    x_ft = torch.cat((x_ft[..., :modes1, :, :], x_ft[..., -modes1:, :, :]), dim=-3)
+
+    # Multiply relevant Fourier modes 
+    out_ft = compl_mul2d(x_ft, weights)
+
+    #Zero-filling the discarded rows by concatenation instead of scattering into a zeroed tensor
+    out_ft = torch.cat((out_ft[..., :modes1, :, :],
+                        out_ft.new_zeros(*out_ft.shape[:-3], size_x - 2*modes1, modes2, 2),
+                        out_ft[..., modes1:, :, :]), dim=-3)
+
+    #Return to physical space. Only the modes2 retained columns are transformed along x, irfft zero-fills the rest.
+    x = torch.fft.ifft(torch.view_as_complex(out_ft), dim=-2)
+    x = torch.fft.irfft(x, n=size_y, dim=-1)
+    return x
+
 class SpectralConv2d(nn.Module):
     def __init__(self, in_channels, out_channels, modes1, modes2):
         super(SpectralConv2d, self).__init__()
@@ -412,30 +291,44 @@ class SpectralConv2d(nn.Module):
         self.modes2 = modes2
 
         self.scale = (1 / (in_channels * out_channels))
-        self.weights1 = nn.Parameter(self.scale * torch.rand(in_channels, out_channels, num_vars, self.modes1, self.modes2, dtype=torch.cfloat))
-        self.weights2 = nn.Parameter(self.scale * torch.rand(in_channels, out_channels, num_vars, self.modes1, self.modes2, dtype=torch.cfloat))
-
-    # Complex multiplication
-    def compl_mul2d(self, input, weights):
-        # (batch, in_channel, x,y ), (in_channel, out_channel, x,y) -> (batch, out_channel, x,y)
-        return torch.einsum("bivxy,iovxy->bovxy", input, weights)
+        #Weights for the top (first modes1 rows) and bottom (last modes1 rows) corners stored as a single contiguous block, stored in spectral_dtype 
+        #Laid out as (var, x, y, real/imag, in_channel, out_channel), the order the batched matmul in compl_mul2d consumes
+        self.weights = nn.Parameter((self.scale * torch.rand(num_vars, 2*self.modes1, self.modes2, 2, in_channels, out_channels)).to(spectral_dtype))
+
+    #Checkpoints keep the original layout that the Plots scripts load: complex weights1 (top rows) and weights2 (bottom rows)
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        weights = torch.view_as_complex(self.weights.detach().float().permute(4, 5, 0, 1, 2, 3).contiguous())
+        destination[prefix + 'weights1'] = weights[..., :self.modes1, :].clone()
+        destination[prefix + 'weights2'] = weights[..., self.modes1:, :].clone()
+
+    def _load_from_state_dict(self, state_dict, prefix, *args):
+        if prefix + 'weights1' in state_dict:
+            weights = torch.cat((state_dict.pop(prefix + 'weights1'), state_dict.pop(prefix + 'weights2')), dim=-2)
+            state_dict[prefix + 'weights'] = torch.view_as_real(weights.to(torch.cfloat)).permute(2, 3, 4, 5, 0, 1)
+        super(SpectralConv2d, self)._load_from_state_dict(state_dict, prefix, *args)
 
     def forward(self, x):
-        batchsize = x.shape[0]
-        #Compute Fourier coeffcients up to factor of e^(- something constant)
-        x_ft = torch.fft.rfft2(x)
-
-        # Multiply relevant Fourier modes 
-        out_ft = torch.zeros(batchsize, self.out_channels, num_vars,  x.size(-2), x.size(-1)//2 + 1, dtype=torch.cfloat, device=x.device)
-        out_ft[:, :, :, :self.modes1, :self.modes2] = \
-            self.compl_mul2d(x_ft[:, :, :, :self.modes1, :self.modes2], self.weights1)
-        out_ft[:, :, :, -self.modes1:, :self.modes2] = \
-            self.compl_mul2d(x_ft[:, :, :, -self.modes1:, :self.modes2], self.weights2)
-
-        #Return to physical space
-        x = torch.fft.irfft2(out_ft, s=(x.size(-2), x.size(-1)))
+        #FFTs kept in single precision, outside of autocast. The multiply runs in the precision of the stored weights.
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            x = spectral_conv2d(x.float(), self.weights, self.modes1, self.modes2)
         return x
 
+#1x1 convolution over (batch*var, channel, x, y). Equivalent to the original Conv3d over (batch, channel, var, x, y), 
+#and checkpoints keep its (out, in, 1, 1, 1) weight so the Plots scripts can load them. 
+class PointwiseConv2d(nn.Conv2d):
+    def __init__(self, in_channels, out_channels):
+        super(PointwiseConv2d, self).__init__(in_channels, out_channels, 1)
+
+    def _save_to_state_dict(self, destination, prefix, keep_vars):
+        super(PointwiseConv2d, self)._save_to_state_dict(destination, prefix, keep_vars)
+        destination[prefix + 'weight'] = destination[prefix + 'weight'].unsqueeze(-1)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args):
+        weight = state_dict.get(prefix + 'weight')
+        if weight is not None and weight.dim() == 5:
+            state_dict[prefix + 'weight'] = weight.squeeze(-1)
+        super(PointwiseConv2d, self)._load_from_state_dict(state_dict, prefix, *args)
+
 class FNO2d(nn.Module):
     def __init__(self, modes1, modes2, width):
         super(FNO2d, self).__init__()
@@ -446,11 +339,12 @@ class FNO2d(nn.Module):
         self.width = width
 
         self.conv = SpectralConv2d(self.width, self.width, self.modes1, self.modes2)
-        self.w = nn.Conv3d(self.width, self.width, 1)
+        self.w = PointwiseConv2d(self.width, self.width).to(memory_format=torch.channels_last)
     
     
     def forward(self, x):
-
+        #Each block needs its own rfft/irfft pair: the GELU acts pointwise in physical space, 
+        #so the output cannot be carried over to the next block in Fourier space. 
         x1 = self.conv(x)
         x2 = self.w(x)
         x = x1+x2
@@ -484,8 +378,6 @@ class FNO_multi(nn.Module):
 
         self.fc0_time  = nn.Linear(T_in+2, self.width_time)
 
-        # self.padding = 8 # pad the domain if input is non-periodic
-
         self.f0 = FNO2d(self.modes1, self.modes2, self.width_time)
         self.f1 = FNO2d(self.modes1, self.modes2, self.width_time)
         self.f2 = FNO2d(self.modes1, self.modes2, self.width_time)
@@ -493,64 +385,70 @@ class FNO_multi(nn.Module):
         self.f4 = FNO2d(self.modes1, self.modes2, self.width_time)
         self.f5 = FNO2d(self.modes1, self.modes2, self.width_time)
 
-        # self.f0 = FNO2d(32, 32, self.width_time)
-        # self.f1 = FNO2d(32, 16, self.width_time)
-        # self.f2 = FNO2d(16, 8, self.width_time)
-        # self.f3 = FNO2d(8, 4, self.width_time)
-        # self.f4 = FNO2d(4, 2, self.width_time)
-        # self.f5 = FNO2d(2, 1, self.width_time)
-
-        # self.dropout = nn.Dropout(p=0.1)
-
-        # self.norm = nn.InstanceNorm2d(self.width)
-        self.norm = nn.Identity()
-
-
         self.fc1_time = nn.Linear(self.width_time, 128)
         self.fc2_time = nn.Linear(128, step)
 
+        #Padded models compute a different function from the unpadded FNO_multi of the Plots scripts. The flag is saved 
+        #with the checkpoint, so a strict load_state_dict into an unpadded model refuses it (unexpected key) instead of silently mispredicting. 
+        if fft_padding:
+            self.register_buffer('fft_padding', torch.tensor(True))
+
+        #Grid of the S x S training discretisation, built once here. Not part of the state dict.
+        self.register_buffer('grid', None, persistent=False)
+        self.set_grid(S, S)
+
 
     def forward(self, x):
-        grid = self.get_grid(x.shape, x.device)
+        batchsize, num_vars = x.shape[0], x.shape[1]
+        grid = self.get_grid(x.shape)
         x = torch.cat((x, grid), dim=-1)
 
 
         x = self.fc0_time(x)
-        x = x.permute(0, 4, 1, 2, 3)
-        # x = self.dropout(x)
+        #Variables folded into the batch: (batch*var, channel, x, y). The 1x1 convolution is shared across variables, 
+        #the spectral weights remain per variable. Channels innermost (NHWC) is already the layout after the permute, so these are views. 
+        x = x.permute(0, 1, 4, 2, 3).flatten(0, 1)
+        x = x.contiguous(memory_format=torch.channels_last)
 
-        # x = F.pad(x, [0,self.padding, 0,self.padding]) # pad the domain if input is non-periodic
+        #Padding the domain up to an FFT friendly size, cropped back after the Fourier layers
+        size_x, size_y = x.shape[-2], x.shape[-1]
+        if fft_padding:
+            x = F.pad(x, [0, fft_size(size_y) - size_y, 0, fft_size(size_x) - size_x])
 
         x0 = self.f0(x)
         x = self.f1(x)
         x = self.f2(x) + x0 
-        # x = self.dropout(x)
         x1 = self.f3(x)
         x = self.f4(x)
         x = self.f5(x) + x1 
 
-        # x = self.dropout(x)
 
-        # x = x[..., :-self.padding, :-self.padding] # pad the domain if input is non-periodic
+        x = x[..., :size_x, :size_y]
 
-        x = x.permute(0, 2, 3, 4, 1)
-        x = x 
+        x = x.unflatten(0, (batchsize, num_vars)).permute(0, 1, 3, 4, 2)
 
         x = self.fc1_time(x)
         x = F.gelu(x)
-        # x = self.dropout(x)
         x = self.fc2_time(x)
         
         return x
 
 #Using x and y values from the simulation discretisation 
-    def get_grid(self, shape, device):
-        batchsize, num_vars, size_x, size_y = shape[0], shape[1], shape[2], shape[3]
+    #Evaluating on another discretisation (super-resolution) needs set_grid called eagerly beforehand, never inside the compiled rollout
+    def set_grid(self, size_x, size_y):
         gridx = torch.tensor(np.linspace(9.5, 10.5, size_x), dtype=torch.float)
-        gridx = gridx.reshape(1, 1, size_x, 1, 1).repeat([batchsize, num_vars, 1, size_y, 1])
+        gridx = gridx.reshape(1, 1, size_x, 1, 1).repeat([1, num_vars, 1, size_y, 1])
         gridy = torch.tensor(np.linspace(-0.5, 0.5, size_y), dtype=torch.float)
-        gridy = gridy.reshape(1, 1, 1, size_y, 1).repeat([batchsize, num_vars, size_x, 1, 1])
-        return torch.cat((gridx, gridy), dim=-1).to(device)
+        gridy = gridy.reshape(1, 1, 1, size_y, 1).repeat([1, num_vars, size_x, 1, 1])
+        grid = torch.cat((gridx, gridy), dim=-1)
+        if self.grid is not None:
+            grid = grid.to(self.grid.device)
+        self.grid = grid
+
+    def get_grid(self, shape):
+        batchsize = shape[0]
+        #The batch dimension is a broadcast view, no copy
+        return self.grid.expand(batchsize, -1, -1, -1, -1)
 
 ## Arbitrary grid discretisation 
     # def get_grid(self, shape, device):
@@ -587,13 +485,19 @@ field = configuration['Field']
 dims = ['rho', 'Phi', 'T']
 num_vars = configuration['Variables']
 
-u_sol = np.load(data)['rho'].astype(np.float32)  / 1e20
-v_sol = np.load(data)['Phi'].astype(np.float32)  / 1e5
-p_sol = np.load(data)['T'].astype(np.float32)    / 1e6
+#Opening the archive once. Each field is still read in as float64, but the scaling writes float32 directly, with no separate astype copy. 
+with np.load(data) as npz:
+    u_sol = np.divide(npz['rho'], 1e20, dtype=np.float32)
+    v_sol = np.divide(npz['Phi'], 1e5, dtype=np.float32)
+    p_sol = np.divide(npz['T'], 1e6, dtype=np.float32)
 
-u_sol = np.nan_to_num(u_sol)
-v_sol = np.nan_to_num(v_sol)
-p_sol = np.nan_to_num(p_sol)
+    x_grid = npz['Rgrid'][0,:].astype(np.float32)
+    y_grid = npz['Zgrid'][:,0].astype(np.float32)
+    t_grid = npz['time'].astype(np.float32)
+
+u_sol = np.nan_to_num(u_sol, copy=False)
+v_sol = np.nan_to_num(v_sol, copy=False)
+p_sol = np.nan_to_num(p_sol, copy=False)
 
 u = torch.from_numpy(u_sol)
 u = u.permute(0, 2, 3, 1)
@@ -609,10 +513,6 @@ x_res = configuration['Spatial Resolution']
 uvp = torch.stack((u,v,p), dim=1)[:,::t_res]
 uvp = np.delete(uvp, (153, 229), axis=0) #Outlier T values 
 
-x_grid = np.load(data)['Rgrid'][0,:].astype(np.float32)
-y_grid = np.load(data)['Zgrid'][:,0].astype(np.float32)
-t_grid = np.load(data)['time'].astype(np.float32)
-
 # #Padding Removed 
 # uvp = uvp[:, :, 3:-3, 3:-3, :]
 # x_grid = x_grid[3:-3]
@@ -643,24 +543,21 @@ print(test_u.shape)
 
 
 # %%
-# a_normalizer = RangeNormalizer(train_a)
 a_normalizer = MinMax_Normalizer(train_a)
-# a_normalizer = GaussianNormalizer(train_a)
 
 train_a = a_normalizer.encode(train_a)
 test_a = a_normalizer.encode(test_a)
 
-# y_normalizer = RangeNormalizer(train_u)
 y_normalizer = MinMax_Normalizer(train_u)
-# y_normalizer = GaussianNormalizer(train_u)
 
 train_u = y_normalizer.encode(train_u)
 test_u_encoded = y_normalizer.encode(test_u)
 
 
 # %%
-train_loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(train_a, train_u), batch_size=batch_size, shuffle=True)
-test_loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(test_a, test_u_encoded), batch_size=batch_size, shuffle=False)
+#The dataset is small enough to be kept on the GPU, batches are indexed directly from it. 
+train_a, train_u = train_a.to(device), train_u.to(device)
+test_a, test_u_encoded = test_a.to(device), test_u_encoded.to(device)
 
 t2 = default_timer()
 print('preprocessing finished, time used:', t2-t1)
@@ -674,12 +571,38 @@ print('preprocessing finished, time used:', t2-t1)
 model = FNO_multi(modes, modes, width_vars, width_time)
 model.to(device)
 
+#TF32 for the remaining single precision matmuls
+torch.set_float32_matmul_precision("high")
+
 run.update_metadata({'Number of Params': int(model.count_params())})
 
 
 print("Number of model params : " + str(model.count_params()))
 
-optimizer = torch.optim.Adam(model.parameters(), lr=configuration['Learning Rate'], weight_decay=1e-4)
+#Autoregressive rollout over T_out: each prediction of step time steps is rolled into the input window for the next call
+def rollout(xx):
+    #Preallocated prediction buffer, keeps the shapes static for graph capture
+    pred = xx.new_empty(*xx.shape[:-1], T)
+    for t in range(0, T, step):
+        im = model(xx)
+        pred[..., t:t + step] = im
+
+        #Rolling the input window: oldest steps out, latest prediction in
+        xx = torch.roll(xx, shifts=-step, dims=-1)
+        xx[..., -step:] = im
+    return pred
+
+#The full unrolled rollout is compiled and captured as a single CUDA graph. The uncompiled model is kept for saving the state dict. 
+if torch.cuda.is_available():
+    compiled_rollout = torch.compile(rollout, mode="reduce-overhead", fullgraph=False)
+else:
+    compiled_rollout = rollout
+
+#Fused (single kernel) Adam update on the GPU, multi-tensor foreach path otherwise
+if torch.cuda.is_available():
+    optimizer = torch.optim.Adam(model.parameters(), lr=configuration['Learning Rate'], weight_decay=1e-4, fused=True)
+else:
+    optimizer = torch.optim.Adam(model.parameters(), lr=configuration['Learning Rate'], weight_decay=1e-4, foreach=True)
 scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=configuration['Scheduler Step'], gamma=configuration['Scheduler Gamma'])
 
 myloss = LpLoss(size_average=False)
@@ -699,25 +622,22 @@ for ep in tqdm(range(epochs)):
     t1 = default_timer()
     train_l2_step = 0
     train_l2_full = 0
-    for xx, yy in train_loader:
-        optimizer.zero_grad()
+    perm = torch.randperm(ntrain, device=device)
+    for i in range(0, ntrain, batch_size):
+        batch_idx = perm[i:i + batch_size]
+        xx, yy = train_a[batch_idx], train_u[batch_idx]
+        optimizer.zero_grad(set_to_none=True)
         loss = 0
-        xx = xx.to(device)
-        yy = yy.to(device)
         # xx = additive_noise(xx)
 
-        for t in range(0, T, step):
-            y = yy[..., t:t + step]
-            im = model(xx)
-            loss += myloss(im.reshape(batch_size, -1), y.reshape(batch_size, -1))
-            # loss += myloss(im.reshape(batch_size, -1)*torch.log(im.reshape(batch_size, -1)), y.reshape(batch_size, -1)*torch.log(y.reshape(batch_size, -1)))
-
-            if t == 0:
-                pred = im
-            else:
-                pred = torch.cat((pred, im), -1)
-
-            xx = torch.cat((xx[..., step:], im), dim=-1)
+        #Mixed precision forward pass and loss. bf16 has the fp32 exponent range, so no gradient scaling.
+        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=torch.cuda.is_available()):
+            pred = compiled_rollout(xx)
+            for t in range(0, T, step):
+                im = pred[..., t:t + step]
+                y = yy[..., t:t + step]
+                loss += myloss(im.reshape(batch_size, -1), y.reshape(batch_size, -1))
+                # loss += myloss(im.reshape(batch_size, -1)*torch.log(im.reshape(batch_size, -1)), y.reshape(batch_size, -1)*torch.log(y.reshape(batch_size, -1)))
 
         train_l2_step += loss.item()
         l2_full = myloss(pred.reshape(batch_size, -1), yy.reshape(batch_size, -1))
@@ -735,22 +655,14 @@ for ep in tqdm(range(epochs)):
 #Validation Loop
     test_loss = 0 
     with torch.no_grad():
-        for xx, yy in test_loader:
-            xx, yy = xx.to(device), yy.to(device)
-
-            for t in range(0, T, step):
-                y = yy[..., t:t + step]
-                out = model(xx)
-
-                if t == 0:
-                    pred = out
-                else:
-                    pred = torch.cat((pred, out), -1)       
+        for i in range(0, ntest, batch_size):
+            xx, yy = test_a[i:i + batch_size], test_u_encoded[i:i + batch_size]
 
-                xx = torch.cat((xx[..., step:], out), dim=-1)
+            pred = compiled_rollout(xx)
             test_loss += myloss(pred.reshape(batch_size, -1), yy.reshape(batch_size, -1)).item() 
         test_loss = test_loss / ntest
 
+    scheduler.step()
     t2 = default_timer()
 
     print('Epochs: %d, Time: %.2f, Train Loss per step: %.3e, Train Loss: %.3e, Test Loss: %.3e' % (ep, t2 - t1, train_l2_step / ntrain / (T / step), train_loss, test_loss))
@@ -767,31 +679,17 @@ torch.save(model.state_dict(),  model_loc)
 # %%
 #Testing 
 batch_size = 1
-test_loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(test_a, test_u_encoded), batch_size=1, shuffle=False)
-pred_set = torch.zeros(test_u.shape)
-index = 0
+pred_set = torch.zeros(test_u.shape, device=device)
 with torch.no_grad():
-    for xx, yy in tqdm(test_loader):
+    for index in tqdm(range(ntest)):
         loss = 0
-        xx, yy = xx.to(device), yy.to(device)
+        xx, yy = test_a[index:index + 1], test_u_encoded[index:index + 1]
         # xx = additive_noise(xx)
         t1 = default_timer()
-        for t in range(0, T, step):
-            y = yy[..., t:t + step]
-            out = model(xx)
-            # loss += myloss(out.reshape(batch_size, -1), y.reshape(batch_size, -1))
-
-            if t == 0:
-                pred = out
-            else:
-                pred = torch.cat((pred, out), -1)       
-
-            xx = torch.cat((xx[..., step:], out), dim=-1)
-
+        pred = rollout(xx)
         t2 = default_timer()
         # pred = y_normalizer.decode(pred)
         pred_set[index]=pred
-        index += 1
         print(t2-t1)
 
 # %% 
@@ -811,7 +709,7 @@ run.update_metadata({'Training Time': float(train_time),
                      'LP Test Error': float(LP_error)
                     })
 
-pred_set = y_normalizer.decode(pred_set.to(device)).cpu()
+pred_set = y_normalizer.decode(pred_set).cpu()
 
 # %%
 #Plotting the comparison plots
@@ -825,71 +723,87 @@ if configuration['Log Normalisation'] == 'Yes':
 
 
 # %%
-output_plot = []
-for dim in range(num_vars):
-    u_field = test_u[idx]
-
-    v_min_1 = torch.min(u_field[dim,:,:,0])
-    v_max_1 = torch.max(u_field[dim,:,:,0])
-
-    v_min_2 = torch.min(u_field[dim, :, :, int(T/2)])
-    v_max_2 = torch.max(u_field[dim, :, :, int(T/2)])
-
-    v_min_3 = torch.min(u_field[dim, :, :, -1])
-    v_max_3 = torch.max(u_field[dim, :, :, -1])
-
-    fig = plt.figure(figsize=plt.figaspect(0.5))
-    ax = fig.add_subplot(2,3,1)
-    pcm =ax.imshow(u_field[dim,:,:,0], cmap=cm.coolwarm, extent=[9.5, 10.5, -0.5, 0.5], vmin=v_min_1, vmax=v_max_1)
-    # ax.title.set_text('Initial')
-    ax.title.set_text('t='+ str(T_in))
-    ax.set_ylabel('Solution')
-    fig.colorbar(pcm, pad=0.05)
-
-
-    ax = fig.add_subplot(2,3,2)
-    pcm = ax.imshow(u_field[dim,:,:,int(T/2)], cmap=cm.coolwarm, extent=[9.5, 10.5, -0.5, 0.5], vmin=v_min_2, vmax=v_max_2)
-    # ax.title.set_text('Middle')
-    ax.title.set_text('t='+ str(int((T+T_in)/2)))
-    ax.axes.xaxis.set_ticks([])
-    ax.axes.yaxis.set_ticks([])
-    fig.colorbar(pcm, pad=0.05)
+#Colormap shared by every panel, looked up once
+CMAP = colormaps['coolwarm']
+
+#Comparison of the solution and the FNO prediction at the first, middle and final output time, given as (3, x, y) stacks of those slices. 
+#Built on a bare Figure with its own Agg canvas, free of pyplot's global state. 
+def plot_comparison(true_slices, pred_slices, var, plot_path):
+    #The time shown in each column's title
+    titles = ['t='+ str(T_in), 't='+ str(int((T+T_in)/2)), 't='+str(T+T_in)]
+
+    #Color range of each column, from the solution slice
+    v_min = true_slices.min(axis=(1,2))
+    v_max = true_slices.max(axis=(1,2))
+
+    #The canvas renders at the figure dpi
+    fig = Figure(figsize=(9,6), dpi=80)
+    canvas = FigureCanvasAgg(fig)
+    for col in range(3):
+        norm = Normalize(v_min[col], v_max[col], clip=True)
+
+        ax_top = fig.add_subplot(2,3,col+1)
+        pcm = ax_top.imshow(true_slices[col], cmap=CMAP, norm=norm, interpolation='nearest', extent=[9.5, 10.5, -0.5, 0.5])
+        ax_top.title.set_text(titles[col])
+
+        ax_bot = fig.add_subplot(2,3,col+4)
+        ax_bot.imshow(pred_slices[col], cmap=CMAP, norm=norm, interpolation='nearest', extent=[9.5, 10.5, -0.5, 0.5])
+
+        if col == 0:
+            ax_top.set_ylabel('Solution')
+            ax_bot.set_ylabel('FNO')
+        else:
+            for ax in (ax_top, ax_bot):
+                ax.axes.xaxis.set_ticks([])
+                ax.axes.yaxis.set_ticks([])
 
+        #Solution and FNO panels of a column share one norm, so one colorbar per column covers both
+        fig.colorbar(pcm, ax=[ax_top, ax_bot], pad=0.05)
 
-    ax = fig.add_subplot(2,3,3)
-    pcm = ax.imshow(u_field[dim,:,:,-1], cmap=cm.coolwarm,  extent=[9.5, 10.5, -0.5, 0.5], vmin=v_min_3, vmax=v_max_3)
-    # ax.title.set_text('Final')
-    ax.title.set_text('t='+str(T+T_in))
-    ax.axes.xaxis.set_ticks([])
-    ax.axes.yaxis.set_ticks([])
-    fig.colorbar(pcm, pad=0.05)
+    ax_bot.title.set_text(var)
 
+    #Smooth colormap fields, so lossy JPEG loses nothing visible and encodes much faster than PNG
+    canvas.print_jpg(plot_path, pil_kwargs={'quality': 85, 'progressive': False, 'optimize': False})
+    #Not registered with pyplot, so there is nothing for plt.close to do. Clearing drops the axes, images and cached RGBA buffers straight away instead of at the next cyclic gc. 
+    fig.clear()
 
-    u_field = pred_set[idx]
 
-    ax = fig.add_subplot(2,3,4)
-    pcm = ax.imshow(u_field[dim,:,:,0], cmap=cm.coolwarm, extent=[9.5, 10.5, -0.5, 0.5], vmin=v_min_1, vmax=v_max_1)
-    ax.set_ylabel('FNO')
+#Fast preview of the same comparison: the colormapped slices are stitched into a single 2x3 image (Solution on top, FNO below) and written with PIL. 
+#No axes or colorbars, a header band carries the variable name and the colour range of each column instead. 
+def preview_comparison(true_slices, pred_slices, var, plot_path):
+    v_min = true_slices.min(axis=(1,2))
+    v_max = true_slices.max(axis=(1,2))
 
-    fig.colorbar(pcm, pad=0.05)
+    rows = [[], []]
+    for col in range(3):
+        norm = Normalize(v_min[col], v_max[col], clip=True)
+        rows[0].append(CMAP(norm(true_slices[col]), bytes=True)[..., :3])
+        rows[1].append(CMAP(norm(pred_slices[col]), bytes=True)[..., :3])
+    grid = np.concatenate([np.concatenate(row, axis=1) for row in rows], axis=0)
 
-    ax = fig.add_subplot(2,3,5)
-    pcm = ax.imshow(u_field[dim,:,:,int(T/2)], cmap=cm.coolwarm,  extent=[9.5, 10.5, -0.5, 0.5], vmin=v_min_2, vmax=v_max_2)
-    ax.axes.xaxis.set_ticks([])
-    ax.axes.yaxis.set_ticks([])
-    fig.colorbar(pcm, pad=0.05)
+    width = true_slices.shape[2]
+    header = np.full((24, grid.shape[1], 3), 255, dtype=np.uint8)
+    image = Image.fromarray(np.concatenate((header, grid), axis=0))
+    draw = ImageDraw.Draw(image)
+    draw.text((2, 1), var, fill='black')
+    for col in range(3):
+        draw.text((col*width + 2, 12), '%.3g : %.3g' % (v_min[col], v_max[col]), fill='black')
+    image.save(plot_path, quality=85, progressive=False, optimize=False)
 
 
-    ax = fig.add_subplot(2,3,6)
-    pcm = ax.imshow(u_field[dim,:,:,-1], cmap=cm.coolwarm,  extent=[9.5, 10.5, -0.5, 0.5], vmin=v_min_3, vmax=v_max_3)
-    ax.axes.xaxis.set_ticks([])
-    ax.axes.yaxis.set_ticks([])
-    fig.colorbar(pcm, pad=0.05)
+# %%
+#Matplotlib figures only when asked for, the stitched preview otherwise
+render_comparison = plot_comparison if configuration['Pretty Plots'] else preview_comparison
 
-    plt.title(dims[dim])
+#Only the three plotted time slices are needed, cut once into contiguous float32 stacks
+plot_times = [0, int(T/2), -1]
+true_slices = [np.ascontiguousarray(test_u[idx, dim][..., plot_times].permute(2,0,1).numpy(), dtype=np.float32) for dim in range(num_vars)]
+pred_slices = [np.ascontiguousarray(pred_set[idx, dim][..., plot_times].permute(2,0,1).numpy(), dtype=np.float32) for dim in range(num_vars)]
 
-    output_plot.append(file_loc + '/Plots/MultiBlobs_' + dims[dim] + '_' + run.name + '.png')
-    plt.savefig(output_plot[dim])
+#Three small images, rendered in-process
+output_plot = [file_loc + '/Plots/MultiBlobs_' + dims[dim] + '_' + run.name + '.jpg' for dim in range(num_vars)]
+for dim in range(num_vars):
+    render_comparison(true_slices[dim], pred_slices[dim], dims[dim], output_plot[dim])
 
 # %%
 
@@ -900,24 +814,21 @@ INPUTS = []
 OUTPUTS = [model_loc, output_plot[0], output_plot[1], output_plot[2]]
 
 
-# Save input files
-for input_file in INPUTS:
-    if os.path.isfile(input_file):
-        run.save(input_file, 'input')
-    elif os.path.isdir(input_file):
-        run.save_directory(input_file, 'input', 'text/plain', preserve_path=True)
-    else:
-        print('ERROR: input file %s does not exist' % input_file)
-
+#Uploads are network bound, so they are overlapped on threads
+def save_artifact(path, category):
+    try:
+        if os.path.isfile(path):
+            run.save(path, category)
+        elif os.path.isdir(path):
+            run.save_directory(path, category, 'text/plain', preserve_path=True)
+        else:
+            print('ERROR: %s file %s does not exist' % (category, path))
+    except Exception as e:
+        print('ERROR: %s file %s could not be saved: %s' % (category, path, e))
 
-# Save output files
-for output_file in OUTPUTS:
-    if os.path.isfile(output_file):
-        run.save(output_file, 'output')
-    elif os.path.isdir(output_file):
-        run.save_directory(output_file, 'output', 'text/plain', preserve_path=True)   
-    else:
-        print('ERROR: output file %s does not exist' % output_file)
+# Save input and output files
+with ThreadPoolExecutor(max_workers=4) as executor:
+    list(executor.map(save_artifact, INPUTS + OUTPUTS, ['input']*len(INPUTS) + ['output']*len(OUTPUTS)))
 
 run.close()
 